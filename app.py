@@ -1,14 +1,35 @@
-from flask import Flask, jsonify, render_template, request
-import requests, time, os
+import os
+if os.environ.get("GEVENT"):
+    # för python app.py med gevent; under gunicorn -k gevent har workern
+    # redan patchat innan app:app laddas, så där behövs inte GEVENT
+    from gevent import monkey
+    monkey.patch_all()
+
+from flask import Flask, Response, render_template, request
+import functools, orjson, requests, threading, time
+from requests.adapters import HTTPAdapter
+from bisect import bisect_left
+from dataclasses import dataclass
 from datetime import datetime, timezone, timedelta
 from zoneinfo import ZoneInfo
 
 app = Flask(__name__)
 TZ = ZoneInfo("Europe/Stockholm")
+NAN = float("nan")
 
 API_URL = "https://api.open-meteo.com/v1/forecast"
-CACHE = {}   # cache per route-id
-TTL = 600    # 10 min
+# nuläget måste vara färskt, timprognosen ändras långsamt
+CACHE_CUR = {}    # cache per route-id
+CACHE_HRLY = {}   # cache per route-id, pekar in i POINT_CACHE
+POINT_CACHE = {}  # timprognos per (lat, lon), delas mellan rutter
+POINT_LOCK = threading.Lock()
+CURRENT_TTL = 300   # 5 min
+HOURLY_TTL = 3600   # 1 h
+REFRESHING = set()  # (byggfunktion, route-id) som hämtas i bakgrunden just nu
+REFRESH_LOCK = threading.Lock()
+COLD_BUILDS = {}  # (byggfunktion, route-id) -> Event för en pågående kallstart
+RESP_CACHE = {}  # (route, start, hastighet) -> (nuläge, timprognos, färdig JSON)
+RESP_CACHE_MAX = 512
 
 # ====== ROUTES (fasta delsträckor i km) ======
 ROUTES = {
@@ -48,10 +69,32 @@ ROUTES = {
     },
 }
 
+# kolumner per rutt (namn, koordinater, kumulativa km) räknas en gång vid start
+for r in ROUTES.values():
+    acc = 0.0
+    r["cum_km"] = []
+    for i, p in enumerate(r["points"]):
+        if i > 0:
+            acc += float(p.get("distance_km_from_prev", 0))
+        r["cum_km"].append(acc)
+    r["names"] = [p["name"] for p in r["points"]]
+    r["lats"] = [p["lat"] for p in r["points"]]
+    r["lons"] = [p["lon"] for p in r["points"]]
+    r["point_keys"] = [(round(p["lat"], 4), round(p["lon"], 4)) for p in r["points"]]
+
+# en delad session så TCP/TLS-anslutningen till API:t återanvänds.
+# Allt går till en värd och varje uppdatering är ett enda batchanrop; som mest
+# hämtas nuläge och timprognos för alla rutter samtidigt, alltså 2 per rutt.
+SESSION = requests.Session()
+SESSION.mount(API_URL, HTTPAdapter(pool_connections=1, pool_maxsize=2 * len(ROUTES), max_retries=2))
+
+# WMO-koder (grovt)
+SNOW_CODES = frozenset(range(71, 78)) | {85, 86}
+FREEZE_CODES = frozenset({66, 67})
+
 def risk(temp, p, wind, code):
-    # WMO-koder (grovt)
-    snow = (71 <= code <= 77) or (code in (85, 86))
-    freeze = code in (66, 67)
+    snow = code in SNOW_CODES
+    freeze = code in FREEZE_CODES
 
     if wind >= 15:
         return "RÖD", "Mycket blåsigt (≥15 m/s)"
@@ -66,98 +109,242 @@ def risk(temp, p, wind, code):
         return "GUL", "Vinterförhållanden"
     return "GRÖN", "Stabilt"
 
+# svarsformat för /api/status, orjson serialiserar dataklasser direkt
+@dataclass(slots=True)
+class NowBlock:
+    t: float
+    p: float
+    w: float
+    code: int
+    risk: str
+    reason: str
+
+@dataclass(slots=True)
+class EtaBlock:
+    time: str
+    clock: str
+    t: float
+    p: float
+    w: float
+    code: int
+    risk: str
+    reason: str
+
+@dataclass(slots=True)
+class PointOut:
+    name: str
+    lat: float
+    lon: float
+    km_from_start: float
+    now: NowBlock
+    eta: EtaBlock
+
+@dataclass(slots=True)
+class StatusOut:
+    route_id: str
+    route_label: str
+    updated: str
+    start: str
+    speed_kmh: float
+    points: list[PointOut]
+
 def parse_start_time(start_str: str | None):
     # "2026-01-02T10:00" eller "10:00"
-    if not start_str:
+    if not start_str or not start_str.strip():
         return datetime.now(TZ)
-    s = start_str.strip()
+    now = datetime.now(TZ)
+    # dagen ingår i nyckeln så "10:00" byter datum vid midnatt
     try:
-        if "T" in s:
-            dt = datetime.fromisoformat(s)
-            if dt.tzinfo is None:
-                return dt.replace(tzinfo=TZ)
-            return dt.astimezone(TZ)
-        if len(s) == 5 and s[2] == ":":
-            now = datetime.now(TZ)
-            hh = int(s[:2]); mm = int(s[3:])
-            return now.replace(hour=hh, minute=mm, second=0, microsecond=0)
+        return _parse_start_cached(start_str.strip(), now.strftime("%Y-%m-%d"))
     except Exception:
-        pass
-    return datetime.now(TZ)
+        return now
+
+@functools.lru_cache(maxsize=256)
+def _parse_start_cached(s: str, today_bucket: str):
+    # ogiltig tid kastar, lru_cache sparar inte undantag så skräp tränger inte undan giltiga poster
+    if "T" in s:
+        dt = datetime.fromisoformat(s)
+        if dt.tzinfo is None:
+            return dt.replace(tzinfo=TZ)
+        return dt.astimezone(TZ)
+    if len(s) == 5 and s[2] == ":":
+        hh = int(s[:2]); mm = int(s[3:])
+        return datetime.fromisoformat(today_bucket).replace(hour=hh, minute=mm, tzinfo=TZ)
+    raise ValueError(f"Ogiltig starttid: {s!r}")
 
 def choose_hourly_at_eta(hourly, eta_dt: datetime):
     times = hourly.get("time", [])
     if not times:
         return None
 
-    target = eta_dt.replace(minute=0, second=0, microsecond=0)
-    target_str = target.strftime("%Y-%m-%dT%H:00")
+    # "_hour_keys" är sorterade YYYYMMDDHH-heltal i lokal tid (se build_hourly)
+    eta = eta_dt.astimezone(TZ)
+    target = ((eta.year * 100 + eta.month) * 100 + eta.day) * 100 + eta.hour
+    idx = min(bisect_left(hourly["_hour_keys"], target), len(times) - 1)
 
-    try:
-        idx = times.index(target_str)
-    except ValueError:
-        best_i, best_diff = 0, None
-        for i, ts in enumerate(times):
-            try:
-                t = datetime.fromisoformat(ts).replace(tzinfo=TZ)
-            except Exception:
-                continue
-            diff = abs((t - target).total_seconds())
-            if best_diff is None or diff < best_diff:
-                best_diff = diff
-                best_i = i
-        idx = best_i
-
-    def get(name, default=None):
+    return hourly["_rows"][idx]
+
+def _iso_hour_key(s):
+    # "YYYY-MM-DDTHH:MM" -> YYYYMMDDHH utan att skapa datetime-objekt
+    return ((int(s[0:4]) * 100 + int(s[5:7])) * 100 + int(s[8:10])) * 100 + int(s[11:13])
+
+def _hourly_rows(hourly):
+    # hela prognosen klassas i ett svep när den hämtas, status() slår bara upp raden
+    times = hourly["time"]
+
+    def col(name, default=None):
         arr = hourly.get(name, [])
-        return arr[idx] if idx < len(arr) else default
+        return [arr[i] if i < len(arr) else default for i in range(len(times))]
 
-    return {
-        "time": times[idx],
-        "temperature_2m": get("temperature_2m", None),
-        "precipitation": get("precipitation", 0),
-        "wind_speed_10m": get("wind_speed_10m", None),
-        "weather_code": get("weather_code", -1),
-    }
+    rows = []
+    for ts, t, p, w, code in zip(times, col("temperature_2m"), col("precipitation", 0),
+                                 col("wind_speed_10m"), col("weather_code", -1)):
+        # JSON-värdena är redan float/int, bara null behöver ersättas
+        t = NAN if t is None else t
+        p = NAN if p is None else p
+        w = NAN if w is None else w
+        code = -1 if code is None else code
+        rows.append((ts, t, p, w, code, *risk(t, p, w, code)))
+    return rows
 
-def fetch_point(lat, lon):
+def fetch_route(points, section):
+    # ett anrop för hela rutten, Open-Meteo svarar med en lista i samma ordning
     params = {
-        "latitude": lat,
-        "longitude": lon,
+        "latitude": ",".join(str(p["lat"]) for p in points),
+        "longitude": ",".join(str(p["lon"]) for p in points),
         "timezone": "Europe/Stockholm",
-        "current": "temperature_2m,precipitation,wind_speed_10m,weather_code",
-        "hourly": "temperature_2m,precipitation,wind_speed_10m,weather_code",
+        section: "temperature_2m,precipitation,wind_speed_10m,weather_code",
     }
-    r = requests.get(API_URL, params=params, timeout=15)
+    r = SESSION.get(API_URL, params=params, timeout=15)
     r.raise_for_status()
     j = r.json()
-    return j.get("current", {}), j.get("hourly", {})
+    if isinstance(j, dict):  # en enda koordinat ger ett objekt, inte en lista
+        j = [j]
+    if len(j) != len(points):
+        raise ValueError(f"Fick {len(j)} av {len(points)} punkter")
+    return [x.get(section, {}) for x in j]
 
-def get_cached_route(route_id: str):
+def fetch_current_batch(points):
+    return fetch_route(points, "current")
+
+def fetch_hourly_batch(points):
+    return fetch_route(points, "hourly")
+
+def build_current(route_id: str):
+    data = fetch_current_batch(ROUTES[route_id]["points"])
+    if not all(cur.get("temperature_2m") is not None for cur in data):
+        raise ValueError("Ofullständigt nuläge")
+    # JSON-värdena är redan float/int, bara saknade/null-värden behöver ersättas
+    t = [NAN if (x := cur.get("temperature_2m")) is None else x for cur in data]
+    p = [NAN if (x := cur.get("precipitation")) is None else x for cur in data]
+    w = [NAN if (x := cur.get("wind_speed_10m")) is None else x for cur in data]
+    code = [-1 if (x := cur.get("weather_code")) is None else x for cur in data]
+    return {
+        "ts": time.time(),
+        "updated": datetime.now(timezone.utc).isoformat(),
+        # nuläget är detsamma för alla requests, så blocken byggs bara här
+        "now": [NowBlock(*x, *risk(*x)) for x in zip(t, p, w, code)],
+    }
+
+def build_hourly(route_id: str):
+    route = ROUTES[route_id]
     now = time.time()
-    entry = CACHE.get(route_id)
-    if not entry or now - entry["ts"] > TTL:
-        route = ROUTES[route_id]
-        raw = []
-        for p in route["points"]:
-            cur, hourly = fetch_point(p["lat"], p["lon"])
-            raw.append({"p": p, "cur": cur, "hourly": hourly})
-        CACHE[route_id] = {
-            "ts": now,
-            "updated": datetime.now(timezone.utc).isoformat(),
-            "raw": raw
-        }
-    return CACHE[route_id]
+    # samma ort (t.ex. Stockholm på E4 och E18) hämtas bara en gång per HOURLY_TTL
+    with POINT_LOCK:
+        stale = [i for i, k in enumerate(route["point_keys"])
+                 if k not in POINT_CACHE or now - POINT_CACHE[k]["ts"] > HOURLY_TTL]
+    if stale:
+        data = fetch_hourly_batch([route["points"][i] for i in stale])
+        if not all(hourly.get("time") for hourly in data):
+            raise ValueError("Ofullständig timprognos")
+        # tiderna görs om till heltalsnycklar en gång här i stället för per request
+        for hourly in data:
+            hourly["_hour_keys"] = [_iso_hour_key(t) for t in hourly["time"]]
+            hourly["_rows"] = _hourly_rows(hourly)
+        ts = time.time()
+        with POINT_LOCK:
+            for i, hourly in zip(stale, data):
+                POINT_CACHE[route["point_keys"][i]] = {"ts": ts, "hourly": hourly}
+    with POINT_LOCK:
+        entries = [POINT_CACHE[k] for k in route["point_keys"]]
+    # rutten är aldrig färskare än sin äldsta delade prognos, annars kan
+    # data leva upp till två HOURLY_TTL
+    return {"ts": min(e["ts"] for e in entries), "hourly": [e["hourly"] for e in entries]}
+
+def _refresh(cache, ttl, build, route_id: str):
+    # byt bara ut cachen mot ett komplett svar, annars behåll det gamla
+    # och försök igen om en minut
+    try:
+        cache[route_id] = build(route_id)
+    except Exception:
+        app.logger.exception("Kunde inte uppdatera %s", route_id)
+        cache[route_id]["ts"] = time.time() - ttl + 60
+    finally:
+        with REFRESH_LOCK:
+            REFRESHING.discard((build, route_id))
+
+def _build_cold(cache, build, route_id: str):
+    # kallstart, inget att servera så vi måste vänta. Bara en tråd per
+    # (build, rutt) hämtar, övriga väntar på den i stället för att också hämta.
+    key = (build, route_id)
+    with REFRESH_LOCK:
+        entry = cache.get(route_id)
+        if entry:
+            return entry
+        done = COLD_BUILDS.get(key)
+        owner = done is None
+        if owner:
+            done = COLD_BUILDS[key] = threading.Event()
+    if not owner:
+        done.wait()
+        entry = cache.get(route_id)
+        if not entry:
+            raise RuntimeError(f"Kunde inte hämta {route_id}")
+        return entry
+    try:
+        cache[route_id] = entry = build(route_id)
+        return entry
+    finally:
+        with REFRESH_LOCK:
+            del COLD_BUILDS[key]
+        done.set()
+
+def _get_cached(cache, ttl, build, route_id: str):
+    entry = cache.get(route_id)
+    if not entry:
+        entry = _build_cold(cache, build, route_id)
+    elif time.time() - entry["ts"] > ttl:
+        # stale-while-revalidate: svara med gammal data och hämta nytt i bakgrunden
+        key = (build, route_id)
+        with REFRESH_LOCK:
+            start = key not in REFRESHING
+            REFRESHING.add(key)
+        if start:
+            threading.Thread(target=_refresh, args=(cache, ttl, build, route_id), daemon=True).start()
+    return entry
+
+def get_cached_route(route_id: str):
+    return {
+        "cur": _get_cached(CACHE_CUR, CURRENT_TTL, build_current, route_id),
+        "hourly": _get_cached(CACHE_HRLY, HOURLY_TTL, build_hourly, route_id),
+    }
+
+# statiska svar byggs en gång, varje request skickar bara färdiga bytes
+ROUTES_BODY = orjson.dumps({
+    "routes": [{"id": rid, "label": r["label"]} for rid, r in ROUTES.items()]
+})
+
+@functools.cache
+def _index_html():
+    return render_template("index.html")
 
 @app.route("/")
 def index():
-    return render_template("index.html")
+    return _index_html()
 
 @app.route("/api/routes")
 def routes():
-    return jsonify({
-        "routes": [{"id": rid, "label": r["label"]} for rid, r in ROUTES.items()]
-    })
+    return Response(ROUTES_BODY, mimetype="application/json")
 
 @app.route("/api/status")
 def status():
@@ -174,69 +361,61 @@ def status():
         speed_kmh = 85.0
 
     cached = get_cached_route(route_id)
-    raw = cached["raw"]
-    route_label = ROUTES[route_id]["label"]
-
-    # ETA från fasta km
-    cum_km = 0.0
-    etas = []
-    for i, item in enumerate(raw):
-        if i == 0:
-            cum_km = 0.0
-        else:
-            cum_km += float(item["p"].get("distance_km_from_prev", 0))
-        eta_dt = start + timedelta(seconds=(cum_km / speed_kmh) * 3600)
-        etas.append((eta_dt, cum_km))
+    cur = cached["cur"]
 
-    out = []
-    for i, item in enumerate(raw):
-        p = item["p"]; cur = item["cur"]; hourly = item["hourly"]
-        eta_dt, km_from_start = etas[i]
+    # samma fråga mot samma väderdata ger samma svar, servera bytes direkt.
+    # Svaret gäller bara för exakt de cacheposter det byggdes från.
+    key = (route_id, start.isoformat(), speed_kmh)
+    hit = RESP_CACHE.get(key)
+    if hit and hit[0] is cur and hit[1] is cached["hourly"]:
+        return Response(hit[2], mimetype="application/json")
 
-        # current
-        t_now = float(cur.get("temperature_2m", float("nan")))
-        p_now = float(cur.get("precipitation", float("nan")))
-        w_now = float(cur.get("wind_speed_10m", float("nan")))
-        code_now = int(cur.get("weather_code", -1))
-        r_now, reason_now = risk(t_now, p_now, w_now, code_now)
+    route = ROUTES[route_id]
+    route_label = route["label"]
+
+    out = []
+    cols = zip(route["names"], route["lats"], route["lons"], route["cum_km"],
+               cur["now"], cached["hourly"]["hourly"])
+    for name, lat, lon, km_from_start, now, hourly in cols:
+        # ETA från fasta km
+        eta_dt = start + timedelta(hours=km_from_start / speed_kmh)
 
         # eta (närmsta timme)
         eta_pick = choose_hourly_at_eta(hourly, eta_dt)
         if eta_pick:
-            t_eta = float(eta_pick["temperature_2m"]) if eta_pick["temperature_2m"] is not None else float("nan")
-            p_eta = float(eta_pick["precipitation"]) if eta_pick["precipitation"] is not None else float("nan")
-            w_eta = float(eta_pick["wind_speed_10m"]) if eta_pick["wind_speed_10m"] is not None else float("nan")
-            code_eta = int(eta_pick["weather_code"])
-            r_eta, reason_eta = risk(t_eta, p_eta, w_eta, code_eta)
-            eta_time = eta_pick["time"]
+            eta_time, t_eta, p_eta, w_eta, code_eta, r_eta, reason_eta = eta_pick
         else:
-            t_eta = p_eta = w_eta = float("nan")
+            t_eta = p_eta = w_eta = NAN
             code_eta = -1
             r_eta, reason_eta = "–", "Ingen prognos"
             eta_time = eta_dt.strftime("%Y-%m-%dT%H:00")
 
-        out.append({
-            "name": p["name"],
-            "lat": p["lat"],
-            "lon": p["lon"],
-            "km_from_start": km_from_start,
-            "now": {"t": t_now, "p": p_now, "w": w_now, "code": code_now, "risk": r_now, "reason": reason_now},
-            "eta": {
-                "time": eta_time,
-                "clock": eta_dt.strftime("%H:%M"),
-                "t": t_eta, "p": p_eta, "w": w_eta, "code": code_eta,
-                "risk": r_eta, "reason": reason_eta
-            }
-        })
-
-    return jsonify({
-        "route_id": route_id,
-        "route_label": route_label,
-        "updated": cached["updated"],
-        "start": start.isoformat(),
-        "speed_kmh": speed_kmh,
-        "points": out
-    })
+        out.append(PointOut(name, lat, lon, km_from_start, now, EtaBlock(
+            eta_time, eta_dt.strftime("%H:%M"),
+            t_eta, p_eta, w_eta, code_eta, r_eta, reason_eta,
+        )))
+
+    # orjson skriver NaN som null, vilket fmt() i frontend redan hanterar
+    body = orjson.dumps(StatusOut(
+        route_id, route_label, cur["updated"], start.isoformat(), speed_kmh, out,
+    ))
+    # utan start blir det "nu" med sekunder, den nyckeln återkommer aldrig
+    if not (start.second or start.microsecond):
+        if len(RESP_CACHE) >= RESP_CACHE_MAX:
+            RESP_CACHE.clear()
+        RESP_CACHE[key] = (cur, cached["hourly"], body)
+    return Response(body, mimetype="application/json")
+
+def _prewarm():
+    # fyll cachen direkt vid start så första besökaren slipper vänta på API:t
+    for rid in ROUTES:
+        try:
+            get_cached_route(rid)
+        except Exception:
+            app.logger.exception("Kunde inte förvärma %s", rid)
+
+# körs vid import så det fungerar även under gunicorn
+threading.Thread(target=_prewarm, daemon=True).start()
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
@@ -0,0 +1,8 @@
+# gunicorn -c gunicorn_conf.py app:app
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+worker_class = "gevent"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+worker_connections = 1000
+timeout = 30